@@ -1,16 +1,38 @@
+# Patch before anything else is imported so threads, queues, sockets and
+# subprocess become cooperative greenlets under the gevent server below
+from gevent import monkey
+monkey.patch_all()
+
 import re
 import os
-import json
+import orjson
+import gzip
+import base64
 import uuid
 import socket
+import threading
+import time
+import queue
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from flask import Flask, request, jsonify, send_from_directory, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, send_from_directory, session, redirect, url_for
+from flask.json.provider import JSONProvider
 from flask_sock import Sock
-from openpyxl import load_workbook
-from docx import Document
+from gevent.pywsgi import WSGIServer
+from simple_websocket import ConnectionClosed
+from wsproto.events import TextMessage
+
+class OrjsonProvider(JSONProvider):
+    """Route jsonify/request.json through orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder='public')
+app.json = OrjsonProvider(app)
 sock = Sock(app)
 
 # ─── Auth config ───────────────────────────────────────────────────────────
@@ -24,40 +46,186 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # ─── In-memory state ───────────────────────────────────────────────────────
 centers   = {}    # { id: { id, name, color, assignedDoc, currentPage, connected } }
-documents = {}    # { id: { id, name, type, pages, uploadedAt, filePath } }
-clients   = {}    # { id: { ws, role, centerId } }
+documents = {}    # { id: { id, name, type, pageOffsets, pagesPath, uploadedAt, filePath } }
+clients   = {}    # { id: { ws, role, centerId, outbox } }
+jobs      = {}    # { id: { id, state, name, document, error, finishedAt } }
+centers_by_slug = {}  # { slug: center } — secondary index over centers
+
+# Parsing shells out to LibreOffice (cooperative under gevent), so a small pool keeps it off the request path
+executor = ThreadPoolExecutor(max_workers=2)
+
+_init_payloads = {}  # { gzip_ok: cached INIT snapshot }, dropped on every broadcast
+
+# Outgoing messages are coalesced per client over this window (seconds)
+FLUSH_INTERVAL = 0.01
+# Clients queued to before yielding so big fanouts don't hold up other handlers
+FANOUT_CHUNK = 50
+# Messages a client may have pending before it is treated as dead
+OUTBOX_SIZE = 256
+# Seconds a finished upload job stays pollable before it is forgotten
+JOB_TTL = 600
+# INIT snapshots at least this many bytes are sent gzipped
+INIT_GZ_MIN = 8 * 1024
+
+# Icons and manifests change rarely; HTML and sw.js keep Flask's no-cache + ETag
+STATIC_MAX_AGE = 86400
+
+# Document keys that describe server storage and are never sent to clients
+DOC_STORAGE_KEYS = ('pageOffsets', 'pagesPath', 'filePath')
+
+_SLUG_RE = re.compile(r'[^a-z0-9]+')
+_ASSIGNED_PREFIX = '{"type":"DOCUMENT_ASSIGNED","currentPage":'
 
 # ─── Helpers ───────────────────────────────────────────────────────────────
 def broadcast(msg):
-    dead = []
-    for cid, c in clients.items():
-        try:
-            c['ws'].send(json.dumps(msg))
-        except Exception:
-            dead.append(cid)
-    for cid in dead:
-        clients.pop(cid, None)
+    # Every change to centers/documents is announced here, so the snapshot is stale now
+    _init_payloads.clear()
+    payload = orjson.dumps(msg).decode()
+    fan_out(list(clients.items()), payload)
 
 def notify_center(center_id, msg):
-    dead = []
-    for cid, c in clients.items():
-        if c.get('centerId') == center_id:
+    send_to_center(center_id, orjson.dumps(msg).decode())
+
+def send_to_center(center_id, payload):
+    """Queue an already-serialized message for every display of a center"""
+    fan_out([(cid, c) for cid, c in list(clients.items()) if c.get('centerId') == center_id], payload)
+
+def fan_out(targets, payload):
+    for i, (cid, c) in enumerate(targets, 1):
+        if i % FANOUT_CHUNK == 0:
+            time.sleep(0)
+        enqueue(cid, c, payload)
+
+def enqueue(cid, client, payload):
+    """Queue a payload for one client; a client that can't keep up is disconnected"""
+    try:
+        client['outbox'].put_nowait(payload)
+    except queue.Full:
+        drop_client(cid)
+
+def drop_client(cid):
+    """Disconnect a client for real: shutting the socket down ends its receive
+    loop, so websocket() cleans up and the browser's onclose reconnects"""
+    client = clients.pop(cid, None)
+    if client:
+        # Shut down first: a backed-up socket would lose (or block on) the close frame
+        try:
+            client['ws'].sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            client['ws'].close()
+        except Exception:
+            pass
+
+def send_frame(ws, payload):
+    """Send one text frame in full. simple_websocket's ws.send() does a single
+    sock.send(); under gevent that can write only part of a large frame."""
+    if not ws.connected:
+        raise ConnectionClosed(ws.close_reason, ws.close_message)
+    ws.sock.sendall(ws.ws.send(TextMessage(data=payload)))
+
+def client_sender(cid, client):
+    """Per-client writer: waits for a message, gathers the burst behind it, sends one frame"""
+    outbox = client['outbox']
+    # INIT is queued first and always goes out on its own: clients only decode
+    # INIT_GZ at the top level, so it must never be merged into a BATCH
+    try:
+        send_frame(client['ws'], outbox.get_nowait())
+    except Exception:
+        drop_client(cid)
+        return
+    while clients.get(cid) is client:
+        try:
+            msgs = [outbox.get(timeout=1)]
+        except queue.Empty:
+            continue
+        time.sleep(FLUSH_INTERVAL)
+        while True:
             try:
-                c['ws'].send(json.dumps(msg))
-            except Exception:
-                dead.append(cid)
-    for cid in dead:
-        clients.pop(cid, None)
+                msgs.append(outbox.get_nowait())
+            except queue.Empty:
+                break
+        if len(msgs) == 1:
+            payload = msgs[0]
+        else:
+            payload = '{"type":"BATCH","msgs":[' + ','.join(msgs) + ']}'
+        try:
+            send_frame(client['ws'], payload)
+        except Exception:
+            # Dead sockets are only ever detected here, by their own sender
+            drop_client(cid)
+            break
 
 def doc_summary(doc):
     return {
         'id': doc['id'],
         'name': doc['name'],
         'type': doc['type'],
-        'pageCount': len(doc.get('pages', [])),
+        'pageCount': len(doc['pageOffsets']),
         'uploadedAt': doc['uploadedAt']
     }
 
+def init_payload(gzip_ok=True):
+    """Pre-serialized INIT message, rebuilt only after centers/documents change.
+    Large snapshots are gzipped once and sent as INIT_GZ to clients that can decode it."""
+    if gzip_ok not in _init_payloads:
+        raw = orjson.dumps({
+            'type': 'INIT',
+            'centers': list(centers.values()),
+            'documents': [d['_summary'] for d in documents.values()]
+        }).decode()
+        if gzip_ok and len(raw) >= INIT_GZ_MIN:
+            gz = base64.b64encode(gzip.compress(raw.encode())).decode()
+            raw = '{"type":"INIT_GZ","data":"' + gz + '"}'
+        _init_payloads[gzip_ok] = raw
+    return _init_payloads[gzip_ok]
+
+def doc_json(doc):
+    """Serialize the document metadata once; _ caches and storage-only keys stay server-side"""
+    return orjson.dumps({k: v for k, v in doc.items()
+                         if not k.startswith('_') and k not in DOC_STORAGE_KEYS}).decode()
+
+def doc_full_json(doc):
+    """Full document JSON: cached metadata plus the page lines from disk"""
+    # JSON escapes newlines inside strings, so b'\n' only ever separates pages
+    with open(doc['pagesPath'], 'rb') as f:
+        pages = f.read().rstrip(b'\n').replace(b'\n', b',').decode()
+    return doc['_meta_json'][:-1] + ',"pages":[' + pages + ']}'
+
+def assigned_payload(doc, page):
+    """DOCUMENT_ASSIGNED envelope. The page-0 string is cached on the doc while it is
+    assigned and shared by every display; other pages only swap the currentPage prefix."""
+    envelope = doc.get('_assigned_json')
+    if envelope is None:
+        envelope = _ASSIGNED_PREFIX + '0,"document":' + doc_full_json(doc) + '}'
+        doc['_assigned_json'] = envelope
+    if page == 0:
+        return envelope
+    return _ASSIGNED_PREFIX + str(int(page)) + envelope[len(_ASSIGNED_PREFIX) + 1:]
+
+def release_assigned_json(doc_id):
+    """Drop a document's cached envelope once no center has it assigned"""
+    doc = documents.get(doc_id)
+    if doc and not any(c.get('assignedDoc') and c['assignedDoc']['id'] == doc_id
+                       for c in centers.values()):
+        doc.pop('_assigned_json', None)
+
+# ─── Page storage ──────────────────────────────────────────────────────────
+def pages_file(doc_id):
+    return os.path.join(UPLOAD_DIR, f'{doc_id}.pages.jsonl')
+
+def write_pages(doc_id, pages):
+    """Write one JSON line per page; returns the file path and [offset, length] per page"""
+    path = pages_file(doc_id)
+    offsets = []
+    with open(path, 'wb') as f:
+        for page in pages:
+            line = orjson.dumps(page)
+            offsets.append([f.tell(), len(line)])
+            f.write(line + b'\n')
+    return path, offsets
+
 # ─── File Parsing ──────────────────────────────────────────────────────────
 def convert_to_pdf(filepath):
     """Convert Excel or Word file to PDF using LibreOffice"""
@@ -83,41 +251,66 @@ def convert_to_pdf(filepath):
     return pdf_path
 
 def parse_file_to_pdf(filepath, original_name):
-    """Convert to PDF and return a single page with embedded PDF viewer"""
+    """Convert to PDF and return a single page carrying the PDF data.
+    The viewer markup is built by the dashboard/display, not stored per page."""
     pdf_path = convert_to_pdf(filepath)
 
     # Read PDF and encode as base64 for inline display
-    import base64
     with open(pdf_path, 'rb') as f:
         pdf_data = base64.b64encode(f.read()).decode()
 
-    # Store PDF path for direct serving
-    pdf_id = os.path.basename(pdf_path)
-
-    html = f'''
-    <div style="width:100%;height:100vh;display:flex;flex-direction:column;">
-      <object 
-        data="data:application/pdf;base64,{pdf_data}"
-        type="application/pdf"
-        style="width:100%;flex:1;min-height:600px;"
-      >
-        <embed 
-          src="data:application/pdf;base64,{pdf_data}" 
-          type="application/pdf"
-          style="width:100%;height:100vh;"
-        />
-      </object>
-    </div>'''
-
-    return [{'title': original_name, 'html': html, 'isPdf': True}]
+    return [{'title': original_name, 'pdf': pdf_data, 'isPdf': True}]
+
+def process_upload(job, filepath, filename, doc_name):
+    """Runs on the upload executor: parse, store pages, then announce the document"""
+    doc_id = str(uuid.uuid4())
+    try:
+        pages = parse_file_to_pdf(filepath, filename)
+        doc_type = 'pdf'
+        pages_path, page_offsets = write_pages(doc_id, pages)
+
+        doc = {
+            'id': doc_id,
+            'name': doc_name,
+            'originalName': filename,
+            'type': doc_type,
+            'pageOffsets': page_offsets,
+            'pagesPath': pages_path,
+            'uploadedAt': datetime.now().isoformat(),
+            'filePath': filepath
+        }
+        doc['_meta_json'] = doc_json(doc)
+        doc['_summary'] = doc_summary(doc)
+        documents[doc['id']] = doc
+        broadcast({'type': 'DOCUMENT_ADDED', 'document': doc['_summary']})
+        job['document'] = doc['_summary']
+        job['state'] = 'done'
+    except Exception as e:
+        print(f'Upload error: {e}')
+        documents.pop(doc_id, None)
+        for path in (filepath, pages_file(doc_id)):
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+        job['error'] = f'Failed to parse file: {str(e)}'
+        job['state'] = 'failed'
+    finally:
+        job['finishedAt'] = time.time()
+
+def prune_jobs():
+    """Forget finished jobs once clients have had JOB_TTL seconds to poll them"""
+    cutoff = time.time() - JOB_TTL
+    for job_id, job in list(jobs.items()):
+        if job.get('finishedAt', cutoff) < cutoff:
+            jobs.pop(job_id, None)
 
 def make_slug(name):
     """Convert 'Assembly 1' → 'assembly-1', ensure uniqueness"""
-    slug = name.lower().strip()
-    slug = re.sub(r'[^a-z0-9]+', '-', slug).strip('-')
+    slug = _SLUG_RE.sub('-', name.lower().strip()).strip('-')
     base = slug
     counter = 2
-    while any(c['slug'] == slug for c in centers.values()):
+    while slug in centers_by_slug:
         slug = f"{base}-{counter}"
         counter += 1
     return slug
@@ -179,18 +372,21 @@ def static_files(filename):
 
 @app.route('/dashboard/manifest.json')
 def dashboard_manifest():
-    response = send_from_directory('public/dashboard', 'manifest.json')
+    response = send_from_directory('public/dashboard', 'manifest.json', max_age=STATIC_MAX_AGE)
     response.headers['Content-Type'] = 'application/manifest+json'
     return response
 
 @app.route('/favicon.ico')
 def favicon():
-    return send_from_directory('public/icons', 'icon-192.png', mimetype='image/png')
+    return send_from_directory('public/icons', 'icon-192.png', mimetype='image/png',
+                               max_age=STATIC_MAX_AGE)
 
 @app.route('/dashboard/<path:filename>')
 def dashboard_static(filename):
     # Allow manifest and icons without login for PWA install
-    if filename in ['manifest.json', 'sw.js'] or filename.startswith('icons/'):
+    if filename == 'manifest.json' or filename.startswith('icons/'):
+        return send_from_directory('public/dashboard', filename, max_age=STATIC_MAX_AGE)
+    if filename == 'sw.js':
         return send_from_directory('public/dashboard', filename)
     if not session.get('logged_in'):
         return redirect('/login')
@@ -198,22 +394,25 @@ def dashboard_static(filename):
 
 @app.route('/sw.js')
 def service_worker():
-    return send_from_directory('public', 'sw.js', mimetype='application/javascript')
+    # No max-age: browsers must revalidate the worker, which is a cheap 304 via ETag
+    response = send_from_directory('public', 'sw.js', mimetype='application/javascript')
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/icons/<path:filename>')
 def icons(filename):
-    return send_from_directory('public/icons', filename)
+    return send_from_directory('public/icons', filename, max_age=STATIC_MAX_AGE)
 
 @app.route('/display/manifest.json')
 def display_manifest():
-    return send_from_directory('public/display', 'manifest.json')
+    return send_from_directory('public/display', 'manifest.json', max_age=STATIC_MAX_AGE)
 
 
 # ─── Documents API ─────────────────────────────────────────────────────────
 @app.route('/api/documents', methods=['GET'])
 @api_login_required
 def get_documents():
-    return jsonify([doc_summary(d) for d in documents.values()])
+    return jsonify([d['_summary'] for d in documents.values()])
 
 @app.route('/api/documents/upload', methods=['POST'])
 @api_login_required
@@ -232,26 +431,20 @@ def upload_document():
     filepath = os.path.join(UPLOAD_DIR, saved_name)
     file.save(filepath)
 
-    try:
-        pages = parse_file_to_pdf(filepath, file.filename)
-        doc_type = 'pdf'
-    except Exception as e:
-        os.remove(filepath)
-        return jsonify({'error': f'Failed to parse file: {str(e)}'}), 500
+    prune_jobs()
+    job = {'id': str(uuid.uuid4()), 'state': 'pending', 'name': filename}
+    jobs[job['id']] = job
+    executor.submit(process_upload, job, filepath, filename, request.form.get('name', filename))
+    return jsonify({'success': True, 'job': job}), 202
 
-    doc_name = request.form.get('name', filename)
-    doc = {
-        'id': str(uuid.uuid4()),
-        'name': doc_name,
-        'originalName': filename,
-        'type': doc_type,
-        'pages': pages,
-        'uploadedAt': datetime.now().isoformat(),
-        'filePath': filepath
-    }
-    documents[doc['id']] = doc
-    broadcast({'type': 'DOCUMENT_ADDED', 'document': doc_summary(doc)})
-    return jsonify({'success': True, 'document': doc_summary(doc)})
+@app.route('/api/documents/jobs/<job_id>', methods=['GET'])
+@api_login_required
+def get_upload_job(job_id):
+    prune_jobs()
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(job)
 
 @app.route('/api/documents/<doc_id>/full', methods=['GET'])
 @api_login_required
@@ -259,7 +452,7 @@ def get_document_full(doc_id):
     doc = documents.get(doc_id)
     if not doc:
         return jsonify({'error': 'Not found'}), 404
-    return jsonify(doc)
+    return Response(doc_full_json(doc), mimetype='application/json')
 
 @app.route('/api/documents/<doc_id>', methods=['DELETE'])
 @api_login_required
@@ -275,10 +468,11 @@ def delete_document(doc_id):
             notify_center(center['id'], {'type': 'DOCUMENT_REMOVED'})
             broadcast({'type': 'CENTER_UPDATED', 'center': center})
 
-    try:
-        os.remove(doc['filePath'])
-    except Exception:
-        pass
+    for path in (doc['filePath'], doc['pagesPath']):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
 
     del documents[doc_id]
     broadcast({'type': 'DOCUMENT_DELETED', 'id': doc_id})
@@ -288,9 +482,7 @@ def delete_document(doc_id):
 @app.route('/api/centers/resolve/<center_ref>', methods=['GET'])
 def resolve_center(center_ref):
     # Try by slug first, then by ID
-    center = next((c for c in centers.values() if c.get('slug') == center_ref), None)
-    if not center:
-        center = centers.get(center_ref)
+    center = centers_by_slug.get(center_ref) or centers.get(center_ref)
     if not center:
         return jsonify({'error': 'Center not found'}), 404
     return jsonify({'id': center['id']})
@@ -319,6 +511,7 @@ def create_center():
         'createdAt': datetime.now().isoformat()
     }
     centers[center['id']] = center
+    centers_by_slug[center['slug']] = center
     broadcast({'type': 'CENTER_ADDED', 'center': center})
     return jsonify({'success': True, 'center': center})
 
@@ -341,7 +534,10 @@ def update_center(center_id):
 def delete_center(center_id):
     if center_id not in centers:
         return jsonify({'error': 'Not found'}), 404
-    del centers[center_id]
+    center = centers.pop(center_id)
+    centers_by_slug.pop(center['slug'], None)
+    if center.get('assignedDoc'):
+        release_assigned_json(center['assignedDoc']['id'])
     broadcast({'type': 'CENTER_DELETED', 'id': center_id})
     return jsonify({'success': True})
 
@@ -354,6 +550,7 @@ def assign_document(center_id):
 
     data = request.json or {}
     doc_id = data.get('documentId')
+    previous = center.get('assignedDoc')
 
     if not doc_id:
         center['assignedDoc'] = None
@@ -365,8 +562,10 @@ def assign_document(center_id):
             return jsonify({'error': 'Document not found'}), 404
         center['assignedDoc'] = {'id': doc['id'], 'name': doc['name'], 'type': doc['type']}
         center['currentPage'] = 0
-        notify_center(center_id, {'type': 'DOCUMENT_ASSIGNED', 'document': doc, 'currentPage': 0})
+        send_to_center(center_id, assigned_payload(doc, 0))
 
+    if previous:
+        release_assigned_json(previous['id'])
     broadcast({'type': 'CENTER_UPDATED', 'center': center})
     return jsonify({'success': True, 'center': center})
 
@@ -384,13 +583,13 @@ def set_page(center_id):
         return jsonify({'error': 'Document not found'}), 404
 
     page = int((request.json or {}).get('page', 0))
-    max_page = len(doc['pages']) - 1
+    max_page = len(doc['pageOffsets']) - 1
     center['currentPage'] = max(0, min(page, max_page))
 
     notify_center(center_id, {
         'type': 'PAGE_CHANGE',
         'page': center['currentPage'],
-        'totalPages': len(doc['pages'])
+        'totalPages': len(doc['pageOffsets'])
     })
     broadcast({'type': 'CENTER_UPDATED', 'center': center})
     return jsonify({'success': True, 'currentPage': center['currentPage']})
@@ -399,17 +598,13 @@ def set_page(center_id):
 @sock.route('/ws')
 def websocket(ws):
     client_id = str(uuid.uuid4())
-    clients[client_id] = {'ws': ws, 'role': None, 'centerId': None}
-
-    # Send initial state
-    try:
-        ws.send(json.dumps({
-            'type': 'INIT',
-            'centers': list(centers.values()),
-            'documents': [doc_summary(d) for d in documents.values()]
-        }))
-    except Exception:
-        return
+    # Initial state goes first in the outbox so it is always sent before any updates
+    client = {'ws': ws, 'role': None, 'centerId': None,
+              'outbox': queue.Queue(maxsize=OUTBOX_SIZE)}
+    # Browsers without DecompressionStream connect with ?gzip=0 and get a plain INIT
+    client['outbox'].put_nowait(init_payload(request.args.get('gzip') != '0'))
+    clients[client_id] = client
+    threading.Thread(target=client_sender, args=(client_id, client), daemon=True).start()
 
     try:
         while True:
@@ -417,13 +612,14 @@ def websocket(ws):
             if raw is None:
                 break
             try:
-                msg = json.loads(raw)
+                msg = orjson.loads(raw)
                 handle_message(client_id, msg)
             except Exception as e:
                 print(f'WS error: {e}')
     finally:
-        client = clients.pop(client_id, None)
-        if client and client.get('centerId'):
+        # The sender may already have dropped this client, so use our own reference
+        clients.pop(client_id, None)
+        if client.get('centerId'):
             cid = client['centerId']
             if cid in centers:
                 centers[cid]['connected'] = False
@@ -450,14 +646,7 @@ def handle_message(client_id, msg):
             if center.get('assignedDoc'):
                 doc = documents.get(center['assignedDoc']['id'])
                 if doc:
-                    try:
-                        client['ws'].send(json.dumps({
-                            'type': 'DOCUMENT_ASSIGNED',
-                            'document': doc,
-                            'currentPage': center['currentPage']
-                        }))
-                    except Exception:
-                        pass
+                    enqueue(client_id, client, assigned_payload(doc, center['currentPage']))
 
 # ─── Start ─────────────────────────────────────────────────────────────────
 if __name__ == '__main__':
@@ -473,4 +662,6 @@ if __name__ == '__main__':
     print(f'   Local     : http://localhost:{PORT}/dashboard')
     print(f'   Network IP: {local_ip}\n')
 
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    # gevent serves every HTTP request and WebSocket as a greenlet, so long-lived
+    # display connections and uploads no longer tie up each other's threads
+    WSGIServer(('0.0.0.0', PORT), app).serve_forever()
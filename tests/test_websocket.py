@@ -0,0 +1,133 @@
+import os
+import sys
+import socket
+import time
+
+import orjson
+import pytest
+from wsproto import WSConnection, ConnectionType
+from wsproto.events import Request, AcceptConnection, TextMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402  (patches with gevent on import)
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+
+PDF_SIZE = 8 * 1024 * 1024
+
+
+@pytest.fixture
+def live_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'UPLOAD_DIR', str(tmp_path))
+    for state in (server.centers, server.documents, server.clients,
+                  server.jobs, server.centers_by_slug):
+        state.clear()
+    server._init_payloads.clear()
+
+    http = WSGIServer(('127.0.0.1', 0), server.app, log=None)
+    http.start()
+    yield http.server_port
+    http.stop()
+
+
+@pytest.fixture
+def dashboard():
+    client = server.app.test_client()
+    client.post('/login', json={'password': server.DASHBOARD_PASSWORD})
+    return client
+
+
+class WSClient:
+    """Minimal raw-socket WebSocket client; reading is left to the test"""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+        self.conn = WSConnection(ConnectionType.CLIENT)
+        self.sock.sendall(self.conn.send(Request(host='localhost', target='/ws')))
+        self.pending = []
+        self.text = ''
+        self.open = False
+        while not self.open:
+            self._read()
+
+    def send(self, msg):
+        self.sock.sendall(self.conn.send(TextMessage(data=orjson.dumps(msg).decode())))
+
+    def _read(self):
+        data = self.sock.recv(65536)
+        assert data, 'server closed the connection'
+        self.conn.receive_data(data)
+        for event in self.conn.events():
+            if isinstance(event, AcceptConnection):
+                self.open = True
+            elif isinstance(event, TextMessage):
+                self.text += event.data
+                if event.message_finished:
+                    msg = orjson.loads(self.text)
+                    self.text = ''
+                    self.pending.extend(msg['msgs'] if msg['type'] == 'BATCH' else [msg])
+
+    def receive(self, msg_type):
+        """Return the next message of msg_type, unpacking BATCH frames"""
+        while True:
+            while self.pending:
+                msg = self.pending.pop(0)
+                if msg['type'] == msg_type:
+                    return msg
+            self._read()
+
+    def close(self):
+        self.sock.close()
+
+
+def add_document(tmp_path, monkeypatch, pdf):
+    monkeypatch.setattr(server, 'parse_file_to_pdf',
+                        lambda filepath, name: [{'title': name, 'pdf': pdf, 'isPdf': True}])
+    filepath = tmp_path / 'big.xlsx'
+    filepath.write_bytes(b'x')
+    job = {'id': 'job', 'state': 'pending', 'name': 'big.xlsx'}
+    server.process_upload(job, str(filepath), 'big.xlsx', 'Big')
+    assert job['state'] == 'done'
+    return job['document']['id']
+
+
+def test_assigning_large_document_sends_whole_frame(live_server, dashboard, tmp_path, monkeypatch):
+    center = dashboard.post('/api/centers', json={'name': 'Assembly 1'}).json['center']
+    doc_id = add_document(tmp_path, monkeypatch, 'A' * PDF_SIZE)
+
+    ws = WSClient(live_server)
+    ws.receive('INIT')
+    ws.send({'type': 'REGISTER_DISPLAY', 'centerId': center['id']})
+    ws.receive('CENTER_UPDATED')
+
+    assert dashboard.post(f"/api/centers/{center['id']}/assign",
+                          json={'documentId': doc_id}).json['success']
+    # Don't read yet, so the server's socket buffer fills mid-frame
+    time.sleep(0.5)
+
+    assigned = ws.receive('DOCUMENT_ASSIGNED')
+    assert assigned['document']['id'] == doc_id
+    assert len(assigned['document']['pages'][0]['pdf']) == PDF_SIZE
+    ws.close()
+
+
+def test_stalled_display_is_disconnected_on_overflow(live_server, dashboard):
+    center = dashboard.post('/api/centers', json={'name': 'Assembly 1'}).json['center']
+
+    ws = WSClient(live_server)
+    ws.receive('INIT')
+    ws.send({'type': 'REGISTER_DISPLAY', 'centerId': center['id']})
+    ws.receive('CENTER_UPDATED')
+
+    # Stop reading: a few large messages fill the socket, then the outbox overflows
+    filler = 'A' * (1024 * 1024)
+    for i in range(server.OUTBOX_SIZE + 150):
+        msg = {'type': 'FILLER', 'data': filler if i < 8 else ''}
+        server.send_to_center(center['id'], orjson.dumps(msg).decode())
+        time.sleep(0)
+
+    deadline = time.time() + 5
+    while server.centers[center['id']]['connected'] and time.time() < deadline:
+        time.sleep(0.05)
+    assert not server.centers[center['id']]['connected']
+    assert not any(c.get('centerId') == center['id'] for c in server.clients.values())
+    ws.close()